@@ -20,6 +20,43 @@ __author__ = "mark@procedural.build"
 __version__ = "2020.04.07"
 
 import os
+from multiprocessing.pool import ThreadPool
+
+# Number of concurrent uploads - uploads are independent PUTs so a small
+# thread pool cuts wall time roughly by the pool size on a slow connection
+UPLOAD_POOL_SIZE = 8
+
+# scandir returns directory entries with cached type info, avoiding the
+# listdir + stat per entry that os.walk does - noticeably faster on case
+# directories with thousands of small files.  Fall back to os.walk where
+# no scandir is available (plain IronPython 2.7 without the backport)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def list_files(dir_path):
+    """Recursively list the paths of all files below dir_path"""
+    paths = []
+    if scandir is None:
+        for root, dirs, fnames in os.walk(dir_path):
+            paths.extend(os.path.join(root, fname) for fname in fnames)
+        return paths
+    for entry in scandir(dir_path):
+        # Don't follow directory symlinks - matches the os.walk fallback
+        # (followlinks=False) and avoids recursing forever on a cycle
+        if entry.is_dir(follow_symlinks=False):
+            paths.extend(list_files(entry.path))
+        elif entry.is_dir():
+            # Symlinked directory - skip it like os.walk does rather than
+            # listing it as a file the upload loop cannot open
+            continue
+        else:
+            paths.append(entry.path)
+    return paths
 
 # Cast the files to a list
 files = files or []
@@ -28,35 +65,59 @@ target_path = target_path or "foam"
 if not taskId:
     raise Exception("taskId is required")
 
-# Check that the files/paths exist and expand folders to a list of all files within
+# Check that the files/paths exist and expand folders to a list of
+# (local path, path relative to the input's parent) pairs.  The base is
+# taken once per input path - the inner walk variables previously shadowed
+# the outer loop's `path`/`files`, so every destination was computed
+# against the last iterated path and uploads landed in the wrong place
 _files = []
-for path in files:
-    if not os.path.exists(path):
-        raise Exception("Path %s not found" % (path))
-
-    if os.path.isdir(path):
-        print("Found directory at %s" % path)
-        for root, dirs, files in os.walk(path):
-            print(root, dirs, files)
-            for file in files:
-                _files.append(os.path.join(root, file))
+for input_path in files:
+    if not os.path.exists(input_path):
+        raise Exception("Path %s not found" % (input_path))
+
+    base = os.path.split(input_path)[0]
+    if os.path.isdir(input_path):
+        print("Found directory at %s" % input_path)
+        _files.extend((full_path, os.path.relpath(full_path, base))
+                      for full_path in list_files(input_path))
     else:
-        _files.append(path)
+        _files.append((input_path, os.path.relpath(input_path, base)))
+
+# Work out the destination url for each local file - the task prefix is
+# constant so build it once outside the loop
+_url_prefix = "/api/task/" + taskId + "/file/"
 
-# Upload the files to the server
-responses = []
-for file in _files:
-    destination_path = os.path.join(target_path, file.replace(os.path.split(path)[0], "")[1:])
+def file_url(relative_path):
+    destination_path = os.path.join(target_path, relative_path)
     print(destination_path)
-    url = "/api/task/%s/file/%s/" % (taskId, destination_path)
+    return _url_prefix + destination_path + "/"
+
+def upload_file(args):
+    file, url = args
+    # Pass the open file handle as the request body so urllib2 streams
+    # it to the socket instead of holding the whole file in memory.
+    # Content-Length must be set explicitly for a file-like body.
     with open(file, 'rb') as local_file:
-        data = local_file.read()
-        if do_upload:
-            response = user.request('PUT', url, data=data, sendRaw=True)
-        else:
-            response = user.get_cached_response('PUT', url)
-        # append to the list of responses
-        responses.append(response)
+        return user.request('PUT', url, data=local_file,
+            extra_headers={'Content-Length': str(os.path.getsize(file))},
+            sendRaw=True
+        )
+
+# Upload the files to the server.  Uploads are independent PUTs so run
+# them on a small thread pool; pool.map keeps the responses in order
+_uploads = [(file, file_url(relative_path)) for (file, relative_path) in _files]
+if do_upload:
+    # Refresh the token once up front so the workers all start with a
+    # fresh one instead of racing to refresh it concurrently
+    user.refresh_token()
+    pool = ThreadPool(min(len(_uploads), UPLOAD_POOL_SIZE) or 1)
+    try:
+        responses = pool.map(upload_file, _uploads)
+    finally:
+        pool.close()
+        pool.join()
+else:
+    responses = [user.get_cached_response('PUT', url) for (file, url) in _uploads]
 
 
 
@@ -22,19 +22,100 @@ __version__ = "2020.04.07"
 
 from urllib import urlencode
 from collections import OrderedDict
-from urllib2 import urlopen, URLError
+from urllib2 import build_opener, URLError
 from urllib2 import Request as BaseRequest
-from datetime import datetime
 import base64
+import hashlib
 import json
+import threading
+import time
 
 # Dictionary for globals
 from scriptcontext import sticky
 
+# Use a faster C JSON implementation for request/response bodies when one is
+# installed (orjson.dumps already returns bytes); fall back to the stdlib
+# which is always available.  Pretty-printing keeps the stdlib for indent=4
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        def _json_dumps(obj):
+            return ujson.dumps(obj).encode('utf8')
+        _json_loads = ujson.loads
+    except ImportError:
+        def _json_dumps(obj):
+            return json.dumps(obj).encode('utf8')
+        _json_loads = json.loads
+
 # Keep a global cache of responses to POST, PUT, PATCH endpoints so that we can
 # use a button to call it once and then still display the response even if the
-# component expires when the button toggles off
-_RESPONSE_CACHE = {}
+# component expires when the button toggles off.  Backed by
+# scriptcontext.sticky so it survives component reloads deterministically
+# (a module-level dict may or may not, depending on how IronPython reloads),
+# and bounded so repeated uploads cannot pin memory - only parsed responses
+# are stored, never request bodies
+_RESPONSE_CACHE_MAXSIZE = 64
+_RESPONSE_CACHE = sticky.setdefault('_response_cache', OrderedDict())
+# OrderedDict updates its linked list in multiple steps and upload worker
+# threads cache their responses concurrently (no GIL under IronPython),
+# so insertion and eviction must be serialized
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# Short-lived cache of GET responses as (expiry timestamp, response), keyed
+# by (url, params).  Only consulted when request() is called with
+# use_cache=True; entries for a url are dropped when a write hits it
+_GET_CACHE = {}
+_GET_CACHE_TTL = 30
+
+# Decoded JWT payloads shared across components via sticky, so the login,
+# task, file and checkJWT components on a canvas decode each token once
+# between them.  Entries are (expiry timestamp, payload) keyed by a digest
+# of the token (not the raw token string) and live a few seconds at most,
+# never past the token's own expiry
+_JWT_PAYLOAD_CACHE = sticky.setdefault('_jwt_payload_cache', {})
+_JWT_PAYLOAD_TTL = 5
+
+def _token_digest(token):
+    return _hash(token.encode('utf8'))
+
+# Map of API operations to http methods
+_OPERATION_MAP = {
+    'list': 'GET',
+    'read': 'GET',
+    'create': 'POST',
+    'update': 'PUT',
+    'partial_update': 'PATCH'
+}
+
+# 16-byte digest for cache keys.  blake2b is the faster choice under
+# CPython (Rhino 7's Python 3); IronPython's hashlib has no blake2b but
+# its .NET-backed sha256 is hardware accelerated - pick at import time
+try:
+    from hashlib import blake2b
+    def _hash(data):
+        return blake2b(data, digest_size=16).digest()
+except ImportError:
+    def _hash(data):
+        return hashlib.sha256(data).digest()[:16]
+
+def _body_digest(data):
+    """16-byte digest of a request body for use in cache keys.  Keying only
+    on (method, url) conflates requests with different bodies - two PUTs to
+    the same url would overwrite each other's cache entries.  Returns None
+    for empty or non-hashable (e.g. file-like) bodies.
+    """
+    if data is None:
+        return None
+    if not isinstance(data, bytes):
+        try:
+            data = _json_dumps(data)
+        except Exception:
+            return None
+    return _hash(data)
 
 # Default urllib2.Request with ironPython only allows GET and POST methods
 # This allows all methods PUT, PATCH, DELETE, etc.
@@ -57,14 +138,35 @@ class Request(BaseRequest):
 # Class for handling user login and requests
 class User():
 
-    content_header = {"content-type": "application/json"}
-
     def __init__(self, username, password, host="http://localhost:8001"):
         self.host_url       = host
+        # Base url with any trailing slash stripped once, so building a
+        # request url is a single concatenation
+        self._base          = host.rstrip('/')
         self.username       = username
         self.password       = password
         self._access_token   = ""
         self._refresh_token  = ""
+        # Request headers for this user - the Authorization entry is kept
+        # up to date wherever the access token is set, so requests do not
+        # rebuild the dict.  Previously headers() updated a dict shared on
+        # the class, so every User instance accumulated each other's tokens
+        self._headers        = {"content-type": "application/json"}
+        # Cache of the decoded JWT payload as (token, payload) so repeated
+        # access does not redo the base64 + JSON decode for the same token
+        self._payload_cache  = (None, None)
+        # Expiry of the current access token as a unix timestamp (float)
+        self._exp_ts         = None
+        # Serializes token rotation and installation so worker threads
+        # cannot refresh concurrently or interleave with requests reading
+        # the headers.  Reentrant because refresh_token holds it while
+        # calling _install_token, which acquires it again
+        self._token_lock     = threading.RLock()
+        # Reuse a single opener for all requests from this user.  Note this
+        # only saves rebuilding the handler chain per call - urllib2 still
+        # opens a fresh HTTPConnection per request, so there is no TCP
+        # keep-alive here
+        self._opener         = build_opener()
 
     @property
     def token(self):
@@ -74,31 +176,62 @@ class User():
     def jwt_payload(self):
         if not self._access_token:
             return None
+        # Return the cached payload if the token has not changed
+        if self._payload_cache[0] == self._access_token:
+            return self._payload_cache[1]
+        # Check the cross-component cache before decoding
+        token_key = _token_digest(self._access_token)
+        cached = _JWT_PAYLOAD_CACHE.get(token_key, None)
+        if cached is not None and cached[0] > time.time():
+            self._payload_cache = (self._access_token, cached[1])
+            return cached[1]
         payload_bytes = self._access_token.split('.')[1].encode('utf8')
-        missing_padding = len(payload_bytes) % 4
-        if missing_padding:
-            payload_bytes += b'=' * (4 - missing_padding)
-        payload = json.loads(base64.b64decode(payload_bytes))
+        # JWT segments are base64url encoded (may contain - and _) with the
+        # padding stripped; -len % 4 restores the padding without a branch
+        payload_bytes += b'=' * (-len(payload_bytes) % 4)
+        payload = _json_loads(base64.urlsafe_b64decode(payload_bytes))
+        self._payload_cache = (self._access_token, payload)
+        # Share with other components, but never let an expired token's
+        # payload come back from the cache
+        expires = time.time() + _JWT_PAYLOAD_TTL
+        exp_timestamp = payload.get('exp', None)
+        if exp_timestamp:
+            expires = min(expires, float(exp_timestamp))
+        _JWT_PAYLOAD_CACHE[token_key] = (expires, payload)
         return payload
 
     @property
     def token_exp_time(self):
         """Seconds remaining until token expiry"""
+        if self._exp_ts is not None:
+            return self._exp_ts - time.time()
         payload = self.jwt_payload
         if payload is None:
             return None
         exp_timestamp = payload.get('exp', None)
         if not exp_timestamp:
             raise Exception('Could not get expiry timestamp from JWT token')
-        now = datetime.utcnow()
-        expiry = datetime.utcfromtimestamp(exp_timestamp)
-        return (expiry - now).total_seconds()
+        return float(exp_timestamp) - time.time()
+
+    def _install_token(self, access_token):
+        """Set a new access token and do all the bookkeeping in one place:
+        decode the payload once, cache the expiry as a unix timestamp (so
+        the hot path in refresh_token is a float subtraction rather than a
+        full JWT decode) and update the Authorization header.  Runs under
+        the token lock so a mid-batch rotation cannot interleave with
+        upload worker threads reading these attributes
+        """
+        with self._token_lock:
+            self._access_token = access_token
+            payload = self.jwt_payload
+            exp_timestamp = payload.get('exp', None) if payload else None
+            self._exp_ts = float(exp_timestamp) if exp_timestamp else None
+            if access_token:
+                self._headers['Authorization'] = 'JWT %s' % access_token
 
     # Some common functions
-    @staticmethod
-    def geturl(host_url, path):
-        host_url = host_url[:-1] if host_url[-1] == "/" else host_url
-        return host_url + path
+    def geturl(self, path):
+        return self._base + path
 
     @staticmethod
     def printJSON(pyObj):
@@ -108,31 +241,24 @@ class User():
         """ Map an operation (list, read, create, update, partial_update) to
         a corresponding http method
         """
-        _operation_map = {
-            'list': 'GET',
-            'read': 'GET',
-            'create': 'POST',
-            'update': 'PUT',
-            'partial_update': 'PATCH'
-        }
-        return _operation_map.get(operation, 'GET')
+        return _OPERATION_MAP.get(operation, 'GET')
 
     def headers(self, extra_headers=None):
-        header = self.content_header
-        if self.token:
-            header.update({'Authorization': 'JWT %s'%(self.token)})
         if extra_headers:
-            header.update(extra_headers)
-        return header
+            return dict(self._headers, **extra_headers)
+        return self._headers
 
     def clear_tokens(self):
         self._access_token = ""
         self._refresh_token = ""
+        self._payload_cache = (None, None)
+        self._exp_ts = None
+        self._headers.pop('Authorization', None)
 
     def get_token(self):
         self.clear_tokens()
         response_dict = self.request('POST', '/auth-jwt/get/', {'username': self.username, 'password': self.password})
-        self._access_token = response_dict.get('access', None)
+        self._install_token(response_dict.get('access', None))
         self._refresh_token = response_dict.get('refresh', None)
         for token_type in ['access', 'refresh']:
             if response_dict.get(token_type, None) is None:
@@ -144,35 +270,43 @@ class User():
         # Check that we have a refresh token first
         if not self._refresh_token:
             return None
-        # Check if the current access token is valid
-        exp_time = self.token_exp_time
-        if exp_time and exp_time > time_remaining:
-            print("No refresh required. Token will expire in", exp_time)
+        # Check if the current access token is valid - a float subtraction
+        # against the cached expiry timestamp, no JWT decode required
+        if self._exp_ts is not None and self._exp_ts - time.time() > time_remaining:
             return self.token
-        # Do the refresh
-        response_dict = self.request('POST', '/auth-jwt/refresh/', {'refresh': self._refresh_token})
-        self._access_token = response_dict['access']
-        print("Refreshed token. Will expire in", self.token_exp_time)
+        # Do the refresh under the token lock so only one worker thread
+        # rotates; the others block here, re-check and find the fresh token
+        with self._token_lock:
+            if self._exp_ts is not None and self._exp_ts - time.time() > time_remaining:
+                return self.token
+            response_dict = self.request('POST', '/auth-jwt/refresh/', {'refresh': self._refresh_token})
+            self._install_token(response_dict['access'])
+            print("Refreshed token. Will expire in", self.token_exp_time)
         return self.token
 
     def verify_token(self):
         response_dict = self.request('POST', '/auth-jwt/verify/', {'token': self.token})
-        self._access_token = response_dict['access']
+        self._install_token(response_dict['access'])
         return self.token
 
-    def set_cached_response(self, method, url, data):
-        print("Setting response cache", (method, url), data)
-        self.response_cache[(method, url)] = data
+    def set_cached_response(self, method, url, response_data, body=None):
+        print("Setting response cache", (method, url), response_data)
+        cache = self.response_cache
+        with _RESPONSE_CACHE_LOCK:
+            cache[(method, url, _body_digest(body))] = response_data
+            # Evict the oldest entries to keep the cache bounded
+            while len(cache) > _RESPONSE_CACHE_MAXSIZE:
+                cache.popitem(last=False)
 
-    def get_cached_response(self, method, url):
-        url = self.geturl(self.host_url, url)
-        return self.response_cache.get((method, url), None)
+    def get_cached_response(self, method, url, data=None):
+        url = self.geturl(url)
+        return self.response_cache.get((method, url, _body_digest(data)), None)
 
     @property
     def response_cache(self):
         return _RESPONSE_CACHE
 
-    def request(self, method, url, data=None, params=None, extra_headers=None, sendRaw=False):
+    def request(self, method, url, data=None, params=None, extra_headers=None, sendRaw=False, use_cache=False):
         cache_response = False
 
         # Check if the access token needs refreshing unless we are calling an auth-jwt endpoint
@@ -180,23 +314,39 @@ class User():
             self.refresh_token()
 
         # Do the full request url
-        url = self.geturl(self.host_url, url)
+        url = self.geturl(url)
         #print("Sending request to url: %s" % url)
 
+        # Serve recent GET responses from the short-lived cache if requested
+        get_cache_key = None
+        if method == 'GET' and use_cache:
+            get_cache_key = (url, frozenset(params.items()) if params else None)
+            cached = _GET_CACHE.get(get_cache_key, None)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+
+        # A write to a url makes any cached GET responses for it stale
+        if method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            for _key in list(_GET_CACHE):
+                if _key[0] == url:
+                    del _GET_CACHE[_key]
+
         # Append url parameters to the url
         url_params = urlencode(params) if params else None
-        url = url + '?%s'%(url_params) if url_params else url
+        url = url + '?' + url_params if url_params else url
 
-        # Set the data that should be sent
-        if method in ('POST', 'PUT', 'PATCH') and not sendRaw:
+        # Set the data that should be sent.  Write responses are cached for
+        # redisplay (raw uploads included - only the parsed response is
+        # stored, never the request body)
+        if method in ('POST', 'PUT', 'PATCH'):
             cache_response = True
-            # Send POST requst with JSON encoded data
-            # Note PUT requests send data as RAW (to handle files)
-            orgData = data
-            try:
-                data = json.dumps(data).encode('utf8')
-            except:
-                pass
+            if not sendRaw:
+                # Send POST requst with JSON encoded data
+                # Note PUT requests send data as RAW (to handle files)
+                if isinstance(data, (bytes, bytearray)):
+                    pass  # already encoded
+                elif data is not None:
+                    data = _json_dumps(data)
 
         # Remove data from GET requests (otherwise urllib will conver this to a POST automatically)
         if method == "GET":
@@ -205,7 +355,7 @@ class User():
         # Get the actual request object
         r = Request(url, method=method, data=data, headers=self.headers(extra_headers))
         try:
-            response = urlopen(r).read().decode('utf8')
+            response = self._opener.open(r).read().decode('utf8')
         except URLError as err:
             print(err.code, err)
             response = err.reason  # e.read().decode('utf8')
@@ -213,13 +363,15 @@ class User():
         # Try to parse the response as JSON, otherwise just return the raw response
         response_data = {}
         try:
-            response_data = json.loads(response)
+            response_data = _json_loads(response)
         except:
             response_data = response
 
-        # Cache the response before returning
+        # Cache the response before returning, keyed by the encoded body
         if cache_response:
-            self.set_cached_response(method, url, response_data)
+            self.set_cached_response(method, url, response_data, body=data)
+        if get_cache_key is not None:
+            _GET_CACHE[get_cache_key] = (time.time() + _GET_CACHE_TTL, response_data)
 
         return response_data
 
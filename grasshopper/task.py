@@ -29,11 +29,8 @@ class Task():
 
     def __init__(self, task_id=""):
         self.task_id = task_id
-
-    @property
-    def url(self):
-        _end = "%s/" % self.task_id if self.task_id else ""
-        return '/api/task/%s' % _end
+        # task_id never changes after construction so build the url once
+        self.url = '/api/task/' + task_id + '/' if task_id else '/api/task/'
 
 # Check for bad input combinations
 if taskId and operation in ('list', 'create'):
@@ -54,7 +51,7 @@ method = user.operation_method(operation)
 if do_request:
     response = user.request(method, _task.url, data={'config': config})
 else:
-    response = user.get_cached_response(method, _task.url)
+    response = user.get_cached_response(method, _task.url, data={'config': config})
     if response:
         print("Using cached response")
 